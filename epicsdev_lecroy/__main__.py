@@ -1,13 +1,24 @@
 """LeCroy oscilloscope device server using epicsdev module."""
 # pylint: disable=invalid-name
-__version__ = 'v1.0.0 26-02-15'  # Initial version adapted from epicsdev_rigol_scope
+__version__ = 'v1.5.0 26-10-19'  # Scope-side averaging and statistics
 
 import sys
+import os
 import time
 from time import perf_counter as timer
 import argparse
 import threading
+import io
+import cProfile
+import pstats
+import asyncio
+import concurrent.futures
+import zlib
 import numpy as np
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
 
 import pyvisa as visa
 from pyvisa.errors import VisaIOError
@@ -67,7 +78,40 @@ def myPVDefs():
     SCPI:'!TRIG_LEVEL', SET:set_scpi}],
 #``````````````````Auxiliary PVs
 ['timing',  'Performance timing', edev.SPV([0.]), {U:'S'}],
+['profile', 'Start/stop profiling of the main loop',
+    edev.SPV(['Profile','Start','Stop'],'WD'), {SET:set_profile}],
+['profileTime', 'Duration of profiling', edev.SPV(10.,'W'), {U:'S', LL:0.1, LH:3600.}],
+['statsMode', 'Host: statistics of polled waveforms, Scope: scope-side statistics of all triggers',
+    edev.SPV(['Host','Scope'],'WD'), {SET:set_statsMode}],
+['avgSweeps', 'Number of sweeps, averaged by the math trace F<n> of channel n in Scope statsMode',
+    edev.SPV(1,'W'), {SET:set_avgSweeps, LL:1, LH:1000000}],
+['sweepRate', 'Rate of sweeps, accumulated by scope-side statistics', edev.SPV(0.), {U:'Hz'}],
+['compression', 'Compression of the c<n>WaveformZ PVs, None: not published',
+    edev.SPV(list(COMPRESSION_CODECS),'WD'), {SET:set_compression}],
+['compressLevel', 'Compression level, higher is smaller but slower. zlib: 0-9, lz4: 0-16, higher levels are limited',
+    edev.SPV(1,'W'), {SET:set_compressLevel, LL:0, LH:max(COMPRESSION_MAXLEVEL)}],
+['compressRatio', 'Average compression ratio of waveforms', edev.SPV(0.), {}],
+['compressTime', 'Average CPU time to compress one waveform', edev.SPV(0.), {U:'S'}],
+['ioQueueDepth', 'Number of instrument requests waiting in the queue, cancelled excluded', edev.SPV(0), {}],
+['ioWaitTime', 'Max waiting time of instrument requests: acquisition, setting, user',
+    edev.SPV([0.,0.,0.]), {U:'S'}],
+['ioTimeouts', 'Number of instrument requests cancelled due to their deadline', edev.SPV(0), {}],
+['profileStats', f'Top {PROFILE_TOPN} functions by internal time, recorded by profiler',
+    edev.SPV(''), {}],
     ]
+    if pargs.replay:
+        pvDefs += [
+#``````````````````Replay PVs
+['replayRate', 'Target rate of replayed acquisitions, 0: as fast as possible',
+    edev.SPV(pargs.replayRate,'W'), {U:'Hz', LL:0., LH:1.e6}],
+['replayLoop', 'Restart replay from the first acquisition when finished',
+    edev.SPV(['Loop','Once'],'WD'), {}],
+['replayIndex', 'Index of the last replayed acquisition', edev.SPV(0), {}],
+['replayRateR', 'Achieved rate of replayed acquisitions', edev.SPV(0.), {U:'Hz'}],
+['replayPublishTime', 'Average time to publish one acquisition', edev.SPV(0.), {U:'S'}],
+['replayLag',  'Delay of the replay behind its schedule, caused by client backpressure',
+    edev.SPV(0.), {U:'S'}],
+        ]
 
     #``````````````Templates for channel-related PVs.
     # The <n> in the name will be replaced with channel number.
@@ -86,6 +130,13 @@ def myPVDefs():
 ['c<n>Waveform', 'Waveform array',           ([0.],), {U:'du'}],
 ['c<n>Mean',     'Mean of the waveform',     (0.,'A'), {U:'V'}],
 ['c<n>Peak2Peak','Peak-to-peak amplitude',   (0.,'A'), {U:'V',**alarm}],
+['c<n>MeanAvg',  'Scope-side average of the waveform mean',  (0.,), {U:'V'}],
+['c<n>Peak2PeakAvg', 'Scope-side average of the peak-to-peak amplitude', (0.,), {U:'V'}],
+['c<n>Sweeps',   'Number of sweeps in the scope-side statistics', (0,), {}],
+['c<n>WaveformZ', 'Delta-encoded and compressed raw samples of the waveform',
+    ([0],'','u8'), {}],
+['c<n>WaveformZDesc', 'Descriptor of c<n>WaveformZ: codec index, npoints, volts per count, offset, xincrement',
+    ([0.]*5,'','f64'), {}],
     ]
     # extend PvDefs with channel-related PVs
     for ch in range(pargs.channels):
@@ -94,10 +145,16 @@ def myPVDefs():
             newpvdef[0] = pvdef[0].replace('<n>',f'{ch+1:02}')
             newpvdef[2] = edev.SPV(*pvdef[2])
             pvDefs.append(newpvdef)
+    if pargs.replay:# there is no device to apply the settings to
+        scopeSetters = (set_setup, set_instrCmdS, set_recLengthS, set_trigger,
+            set_scpi, set_vbs)
+        for pvdef in pvDefs:
+            if pvdef[3].get(SET) in scopeSetters:
+                pvdef[2].writable = False# puts will be rejected by the server
+                pvdef[3] = {k:v for k,v in pvdef[3].items() if k != SET}
     return pvDefs
 #,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,
 #``````````````````Constants
-Threadlock = threading.Lock()
 OK = 0
 NotOK = -1
 IF_CHANGED = True
@@ -111,6 +168,21 @@ LECROY_DESCRIPTOR_SIZE = 346  # Typical LeCroy WAVEDESC header size
 LECROY_VERTICAL_RESOLUTION = 25.0  # Approximate vertical resolution (full scale / max ADC value)
 DEFAULT_TIMEBASE_DIVISIONS = 50  # Default divisions for timebase calculation
 DEFAULT_NPOINTS = 1000  # Default number of points when not parsed from descriptor
+# Recording format: per channel, c<nn>.dat holds little-endian int16 samples of
+# consecutive acquisitions, c<nn>.desc holds one float64 descriptor per acquisition:
+RECORD_DESC = ('trigTime', 'vdiv', 'offset', 'xincrement', 'npoints')
+REPLAY_SLICE = 0.1  # Max time (S) spent in one replay poll, before returning to the main loop
+PROFILE_TOPN = 20  # Number of functions, reported in the profileStats PV
+# Priorities of instrument requests, lower value is served first
+PRIO_ACQ, PRIO_SETTING, PRIO_USER = 0, 1, 2
+IO_DEADLINE = (20., 10., 30.)  # Default deadlines (S) of requests for each priority
+COMPRESSION_CODECS = ('None', 'zlib', 'lz4')  # index is published in c<n>WaveformZDesc
+COMPRESSION_MAXLEVEL = (0, 9, 16)  # max compression level of each codec
+# Scope-side statistics of channel n use measurement slots P<2n-1> (mean) and P<2n> (peak-to-peak)
+STATS_PARAMS = ('Mean', 'PeakToPeak')
+MEASURE_SLOTS = 8  # Number of measurement slots P1..P8 of MAUI scopes
+# Mapping of app.Acquisition.TriggerMode to TRIG_MODE replies
+VBS_TRIGGER_MODES = {'Auto':'AUTO', 'Normal':'NORM', 'Single':'SINGLE', 'Stopped':'STOP'}
 #,,,,,,,,,,,,,,,,,,
 class C_():
     """Namespace for module properties"""
@@ -129,17 +201,40 @@ class C_():
     xincrement = 0.
     npoints = 0
     ypars = None
+    recordFiles = {}# {channel:(samplesFile, descFile)}
+    replay = {}# {channel:(samples, descriptors, starts)}, memory-mapped recordings
+    replayCount = 0
+    replayIndex = 0
+    replayNext = 0.
+    replayRate = 0.
+    replayStats = [0, 0., 0.]# published, publishTime, startTime
+    profiler = None
+    ioProfiler = None# profiler of the I/O thread, needed for python < 3.12
+    profileEnd = 0.
+    ioLoop = None
+    ioQueue = None
+    ioExecutor = None
+    ioSeq = 0
+    ioWaiting = set()# futures of queued requests, which are not cancelled
+    ioWaitMax = [0., 0., 0.]# per priority
+    ioTimeouts = 0
+    compression = 'None'
+    compressExecutor = None
+    compressSlots = None# limits number of waveforms waiting for compression
+    compressStats = [0, 0, 0, 0.]# waveforms, rawBytes, compressedBytes, cpuTime
+    statsMode = 'Host'
+    statsQuery = ''
+    statsSweeps = (None, 0, 0.)# channel, sweeps, time of the previous reading
 #``````````````````Setters````````````````````````````````````````````````````
-def scopeCmd(cmd):
+def scopeCmd(cmd, prio=PRIO_SETTING):
     """Send command to scope, return reply if any."""
     edev.printv(f'>scopeCmd: {cmd}')
     reply = None
     try:
-        with Threadlock:
-            if '?' in cmd:
-                reply = C_.scope.query(cmd)
-            else:
-                C_.scope.write(cmd)
+        if '?' in cmd:
+            reply = scope_io(prio, C_.scope.query, cmd)
+        else:
+            scope_io(prio, C_.scope.write, cmd)
     except Exception:
         handle_exception(f'in scopeCmd{cmd}')
     return reply
@@ -147,7 +242,7 @@ def scopeCmd(cmd):
 def set_instrCmdS(cmd, *_):
     """Setter for the instrCmdS PV"""
     edev.publish('instrCmdR','')
-    reply = scopeCmd(cmd)
+    reply = scopeCmd(cmd, PRIO_USER)
     if reply is not None:
         edev.publish('instrCmdR',reply)
     edev.publish('instrCmdS',cmd)
@@ -156,9 +251,14 @@ def serverStateChanged(newState:str):
     """Start device function called when server is started"""
     if newState == 'Start':
         edev.printi('start_device called')
+        if pargs.replay:
+            C_.replayIndex = 0
+            C_.replayNext = timer()
+            C_.replayStats = [0, 0., timer()]
+            return
         configure_scope()
         adopt_local_setting()
-        C_.scope.write('TRIG_MODE AUTO')
+        scope_io(PRIO_SETTING, C_.scope.write, 'TRIG_MODE AUTO')
         wait_for_scopeReady()
 
     elif newState == 'Stop':
@@ -173,16 +273,14 @@ def set_setup(action_slot, *_):
     action = str(action_slot)
     status = f'Panel setup action: {action}'
     if action == 'Store Panel':
-        with Threadlock:
-            C_.scope.write('PANEL_SETUP STORE,"LATEST"')
+        scope_io(PRIO_SETTING, C_.scope.write, 'PANEL_SETUP STORE,"LATEST"')
     elif action == 'Recall Panel':
         status = 'Panel setup recalled'
         if str(edev.pvv('server')).startswith('Start'):
             edev.printw('Please set server to Stop before Recalling')
             edev.publish('setup','Setup')
             return NotOK
-        with Threadlock:
-            C_.scope.write('PANEL_SETUP RECALL,"LATEST"')
+        scope_io(PRIO_SETTING, C_.scope.write, 'PANEL_SETUP RECALL,"LATEST"')
     edev.publish('setup','Setup')
     edev.publish('status', status)
     if action == 'Recall Panel':
@@ -192,8 +290,7 @@ def set_trigger(value, *_):
     """setter for the trigger PV"""
     edev.printv(f'set_trigger: {value}')
     if str(value) == 'Force!':
-        with Threadlock:
-            C_.scope.write('ARM')
+        scope_io(PRIO_SETTING, C_.scope.write, 'ARM')
         edev.publish('trigger','Trigger')
 
 def set_recLengthS(value, *_):
@@ -218,20 +315,18 @@ def set_recLengthS(value, *_):
         '10M': '10M'
     }
     mem_size = mem_map.get(value, value)
-    with Threadlock:
-        C_.scope.write(f'MEMORY_SIZE {mem_size}')
+    scope_io(PRIO_SETTING, C_.scope.write, f'MEMORY_SIZE {mem_size}')
     edev.publish('recLengthS', value)
     update_scopeParameters()
 
 def set_scpi(value, pv, *_):
     """setter for SCPI-associated PVs"""
-    print(f'set_scpi({value},{pv.name})')
+    edev.printv(f'set_scpi({value},{pv.name})')
     scpi = C_.scpi.get(pv.name,None)
     if scpi is None:
         edev.printe(f'No SCPI defined for PV {pv.name}')
         return
     scpi = scpi.replace('<n>',pv.name[2])# replace <n> with channel number
-    print(f'set_scpi: {scpi} {value}')
     scpi += f' {value}' if pv.writable else '?'
     edev.printv(f'set_scpi command: {scpi}')
     reply = scopeCmd(scpi)
@@ -241,7 +336,7 @@ def set_scpi(value, pv, *_):
 
 def set_vbs(value, pv, *_):
     """setter for VBS script commands"""
-    print(f'set_vbs({value},{pv.name})')
+    edev.printv(f'set_vbs({value},{pv.name})')
     scpi = C_.scpi.get(pv.name,None)
     if scpi is None:
         edev.printe(f'No SCPI defined for PV {pv.name}')
@@ -253,33 +348,191 @@ def set_vbs(value, pv, *_):
     scopeCmd(vbs_cmd)
     edev.publish(pv.name, value)
 
+def set_statsMode(value, *_):
+    """setter for the statsMode PV"""
+    mode = str(value)
+    if pargs.replay:
+        edev.printw('Scope-side statistics are not available in replay mode')
+        edev.publish('statsMode', C_.statsMode)
+        return NotOK
+    try:
+        configure_scopeStats(mode == 'Scope')
+    except Exception:
+        handle_exception('in configure_scopeStats')
+        edev.publish('statsMode', C_.statsMode)
+        return NotOK
+    C_.statsMode = mode
+    edev.publish('statsMode', mode)
+
+def set_avgSweeps(value, *_):
+    """setter for the avgSweeps PV"""
+    edev.publish('avgSweeps', value)
+    if C_.statsMode == 'Scope':
+        for ch in stats_channels():
+            scopeCmd(f'VBS app.Math.F{ch}.Operator1Setup.Sweeps = {value}')
+
+def set_compression(value, *_):
+    """setter for the compression PV"""
+    codec = str(value)
+    if codec == 'lz4' and lz4 is None:
+        edev.printw('Module lz4 is not installed, please pip install lz4')
+        edev.publish('compression', C_.compression)
+        return NotOK
+    if codec != 'None' and C_.compressExecutor is None:
+        C_.compressExecutor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        C_.compressSlots = threading.Semaphore(pargs.channels)
+    C_.compression = codec
+    edev.publish('compression', codec)
+    set_compressLevel(edev.pvv('compressLevel'))
+
+def set_compressLevel(value, *_):
+    """setter for the compressLevel PV, warns if the level exceeds the codec limit"""
+    maxLevel = COMPRESSION_MAXLEVEL[COMPRESSION_CODECS.index(C_.compression)]
+    if C_.compression != 'None' and int(value) > maxLevel:
+        edev.printw(f'Max compression level of {C_.compression} is {maxLevel}, it will be used')
+    edev.publish('compressLevel', value)
+
+def set_profile(value, *_):
+    """setter for the profile PV"""
+    action = str(value)
+    if action == 'Start':
+        if C_.profiler is not None:# the PV keeps showing Start
+            edev.printw('Profiling is already running')
+            return
+        C_.profileEnd = time.time() + edev.pvv('profileTime')
+        C_.profiler = cProfile.Profile()
+        # Since python 3.12 a profiler covers all threads, before that
+        # the I/O thread needs its own profiler
+        if sys.version_info < (3,12) and C_.ioExecutor is not None:
+            C_.ioProfiler = cProfile.Profile()
+        edev.publish('status', f'Profiling for {edev.pvv("profileTime")} S')
+    elif action == 'Stop':
+        if C_.profiler is None:
+            edev.printw('Profiling is not running')
+            edev.publish('profile', 'Profile')
+            return
+        C_.profileEnd = 0.# profiling will be finished in the main loop
+    edev.publish('profile', action)
+
 #``````````````````Instrument communication functions`````````````````````````
+def init_io():
+    """Start the asyncio loop, which serializes all instrument requests"""
+    C_.ioLoop = asyncio.new_event_loop()
+    # blocking pyvisa calls are executed in a single dedicated thread
+    C_.ioExecutor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    threading.Thread(target=C_.ioLoop.run_forever, daemon=True).start()
+    C_.ioQueue = asyncio.run_coroutine_threadsafe(new_ioQueue(), C_.ioLoop).result()
+    asyncio.run_coroutine_threadsafe(io_worker(), C_.ioLoop)
+
+async def new_ioQueue():
+    """Create the request queue, it should belong to the I/O loop"""
+    return asyncio.PriorityQueue()
+
+def io_call(func, args):
+    """Execute instrument call in the I/O thread, profile it if requested"""
+    profiler = C_.ioProfiler
+    if profiler is None:
+        return func(*args)
+    profiler.enable()
+    try:
+        return func(*args)
+    finally:
+        profiler.disable()
+
+async def io_worker():
+    """Serve queued instrument requests in the order of their priorities"""
+    loop = asyncio.get_running_loop()
+    while True:
+        prio, _, tqueued, fut, func, args = await C_.ioQueue.get()
+        C_.ioWaiting.discard(fut)
+        if fut.cancelled():# requester gave up waiting
+            continue
+        C_.ioWaitMax[prio] = max(C_.ioWaitMax[prio], timer() - tqueued)
+        # the call cannot be interrupted, the instrument is busy until it returns
+        efut = loop.run_in_executor(C_.ioExecutor, io_call, func, args)
+        await asyncio.wait({efut})
+        if fut.cancelled():
+            continue
+        exc = efut.exception()
+        if exc is None:
+            fut.set_result(efut.result())
+        else:
+            fut.set_exception(exc)
+
+async def io_request(prio, func, args):
+    """Queue the request and wait for its result"""
+    fut = asyncio.get_running_loop().create_future()
+    C_.ioSeq += 1
+    C_.ioQueue.put_nowait((prio, C_.ioSeq, timer(), fut, func, args))
+    C_.ioWaiting.add(fut)
+    try:
+        return await fut
+    finally:# cancelled requests stay in the queue, but they are not waiting
+        C_.ioWaiting.discard(fut)
+
+def scope_io(prio, func, *args, deadline=None):
+    """Execute func(*args) in the instrument I/O thread and return its result.
+    Requests with lower prio are served first. The request is cancelled
+    and TimeoutError raised if it is not completed within deadline seconds."""
+    if deadline is None:
+        deadline = IO_DEADLINE[prio]
+    cfut = asyncio.run_coroutine_threadsafe(io_request(prio, func, args), C_.ioLoop)
+    try:
+        return cfut.result(deadline)
+    except concurrent.futures.TimeoutError:
+        cfut.cancel()
+        C_.ioTimeouts += 1
+        raise TimeoutError(f'Deadline {deadline} S exceeded for {func.__name__}{args}') from None
+
+async def cancel_ioTasks():
+    """Cancel the request worker and pending requests"""
+    tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+def stop_io():
+    """Stop the I/O loop and the executors"""
+    if C_.ioLoop is not None:
+        try:
+            asyncio.run_coroutine_threadsafe(cancel_ioTasks(), C_.ioLoop).result(1.)
+        except concurrent.futures.TimeoutError:
+            edev.printw('I/O requests were not cancelled in time')
+        C_.ioLoop.call_soon_threadsafe(C_.ioLoop.stop)
+    for executor in (C_.ioExecutor, C_.compressExecutor):
+        if executor is not None:
+            executor.shutdown(wait=False)
+
+def update_ioStats():
+    """Publish statistics of the instrument request queue"""
+    edev.publish('ioQueueDepth', len(C_.ioWaiting))
+    edev.publish('ioWaitTime', [round(i,6) for i in C_.ioWaitMax])
+    edev.publish('ioTimeouts', C_.ioTimeouts, IF_CHANGED)
+    C_.ioWaitMax = [0., 0., 0.]
+
 def query(pvnames, explicitSCPIs=None):
     """Execute query request of the instrument for multiple PVs"""
     scpis = [C_.scpi[pvname] for pvname in pvnames]
     if explicitSCPIs:
         scpis += explicitSCPIs
     combinedScpi = ';'.join(scpis) + '?'
-    print(f'combinedScpi: {combinedScpi}')
-    with Threadlock:
-        r = C_.scope.query(combinedScpi)
+    edev.printv(f'combinedScpi: {combinedScpi}')
+    r = scope_io(PRIO_SETTING, C_.scope.query, combinedScpi)
     return r.split(';')
 
 def configure_scope():
     """Send commands to configure data transfer"""
     edev.printi('configure_scope')
-    with Threadlock:
-        # Configure for binary data transfer (WORD format)
-        C_.scope.write("COMM_FORMAT DEF9,WORD,BIN")
-        C_.scope.write("COMM_ORDER HI")  # Big-endian byte order
+    # Configure for binary data transfer (WORD format)
+    scope_io(PRIO_SETTING, C_.scope.write, "COMM_FORMAT DEF9,WORD,BIN")
+    scope_io(PRIO_SETTING, C_.scope.write, "COMM_ORDER HI")  # Big-endian byte order
 
 def wait_for_scopeReady():
     """Wait for scope to be in ready state after acquisition"""
     for attempt in range(5):
         time.sleep(0.1)
         try:
-            with Threadlock:
-                trigStatus = C_.scope.query('TRIG_MODE?')
+            trigStatus = scope_io(PRIO_SETTING, C_.scope.query, 'TRIG_MODE?')
             if trigStatus.strip() in ['AUTO', 'NORM']:
                 break
         except Exception:
@@ -287,51 +540,54 @@ def wait_for_scopeReady():
     if attempt == 4:
         edev.printw(f'Scope may not be ready after {attempt*0.1} seconds')
 
+def write_read_raw(cmd):
+    """Write command and read the binary reply, must be executed as one request"""
+    C_.scope.write(cmd)
+    return C_.scope.read_raw()
+
 def update_scopeParameters():
     """Update scope timing PVs"""
     # Query horizontal parameters
     try:
-        with Threadlock:
-            # Query waveform description for first enabled channel
-            enabled_ch = None
-            for ch in range(1, pargs.channels+1):
-                trace = C_.scope.query(f'C{ch}:TRACE?')
-                if 'ON' in trace:
-                    enabled_ch = ch
-                    break
-            
-            if enabled_ch is None:
-                return
-                
-            # Get waveform descriptor
-            C_.scope.write(f'C{enabled_ch}:WF? DESC')
-            desc = C_.scope.read_raw()
-            
-            # Parse descriptor to get timing information
-            # LeCroy descriptor format is complex, simplified here
-            # In practice, need to parse the WAVEDESC structure
-            
-            # For now, query basic parameters
-            # TODO: Parse WAVEDESC structure for accurate timing parameters
-            timebase = C_.scope.query('TIME_DIV?')
-            C_.xincrement = float(timebase) / DEFAULT_TIMEBASE_DIVISIONS  # Approximate
-            C_.npoints = DEFAULT_NPOINTS  # Default, should parse from descriptor
-            
-            taxis = np.arange(0, C_.npoints) * C_.xincrement
-            edev.publish('tAxis', taxis)
-            edev.publish('recLengthR', C_.npoints, IF_CHANGED)
-            edev.publish('timePerDiv', float(timebase), IF_CHANGED)
-            if C_.xincrement > 0:
-                edev.publish('samplingRate', 1./C_.xincrement, IF_CHANGED)
+        # Query waveform description for first enabled channel
+        enabled_ch = None
+        for ch in range(1, pargs.channels+1):
+            trace = scope_io(PRIO_SETTING, C_.scope.query, f'C{ch}:TRACE?')
+            if 'ON' in trace:
+                enabled_ch = ch
+                break
+        
+        if enabled_ch is None:
+            return
             
-            # Update channel enable status
-            C_.channelsTriggered = []
-            for ch in range(1, pargs.channels+1):
-                trace = C_.scope.query(f'C{ch}:TRACE?')
-                is_on = 'ON' in trace
-                edev.publish(f'c{ch:02}OnOff', '1' if is_on else '0', IF_CHANGED)
-                if is_on:
-                    C_.channelsTriggered.append(ch)
+        # Get waveform descriptor
+        desc = scope_io(PRIO_SETTING, write_read_raw, f'C{enabled_ch}:WF? DESC')
+        
+        # Parse descriptor to get timing information
+        # LeCroy descriptor format is complex, simplified here
+        # In practice, need to parse the WAVEDESC structure
+        
+        # For now, query basic parameters
+        # TODO: Parse WAVEDESC structure for accurate timing parameters
+        timebase = scope_io(PRIO_SETTING, C_.scope.query, 'TIME_DIV?')
+        C_.xincrement = float(timebase) / DEFAULT_TIMEBASE_DIVISIONS  # Approximate
+        C_.npoints = DEFAULT_NPOINTS  # Default, should parse from descriptor
+        
+        taxis = np.arange(0, C_.npoints) * C_.xincrement
+        edev.publish('tAxis', taxis)
+        edev.publish('recLengthR', C_.npoints, IF_CHANGED)
+        edev.publish('timePerDiv', float(timebase), IF_CHANGED)
+        if C_.xincrement > 0:
+            edev.publish('samplingRate', 1./C_.xincrement, IF_CHANGED)
+        
+        # Update channel enable status
+        C_.channelsTriggered = []
+        for ch in range(1, pargs.channels+1):
+            trace = scope_io(PRIO_SETTING, C_.scope.query, f'C{ch}:TRACE?')
+            is_on = 'ON' in trace
+            edev.publish(f'c{ch:02}OnOff', '1' if is_on else '0', IF_CHANGED)
+            if is_on:
+                C_.channelsTriggered.append(ch)
     except Exception as e:
         edev.printw(f'Error updating scope parameters: {e}')
 
@@ -385,8 +641,10 @@ def handle_exception(where):
     msg = 'ERR:'+tokens[0] if tokens[0] == 'VI_ERROR_TMO' else exceptionText
     msg = msg+': '+where
     edev.printe(msg)
-    with Threadlock:
-        C_.scope.write('*CLS')
+    try:
+        scope_io(PRIO_SETTING, C_.scope.write, '*CLS')
+    except Exception as e:
+        edev.printw(f'Could not clear status after exception: {e}')
     return -1
 
 def adopt_local_setting():
@@ -406,8 +664,7 @@ def adopt_local_setting():
                 continue
                 
             try:
-                with Threadlock:
-                    v = C_.scope.query(scpi + '?').strip()
+                v = scope_io(PRIO_SETTING, C_.scope.query, scpi + '?').strip()
                 
                 pv = edev.pvobj(parname)
                 pvValue = pv.current()
@@ -440,15 +697,14 @@ def trigger_is_detected():
     """check if scope was triggered"""
     ts = timer()
     try:
-        with Threadlock:
-            # LeCroy: Check trigger state
-            trigStatus = C_.scope.query('TRIG_MODE?').strip()
-            
-            # Check if stopped externally
-            if trigStatus == 'STOP':
-                edev.set_server('Stop')
-                edev.printw('Scope was stopped externally. Server stopped.')
-                return False
+        # LeCroy: Check trigger state
+        trigStatus = scope_io(PRIO_ACQ, C_.scope.query, 'TRIG_MODE?').strip()
+        
+        # Check if stopped externally
+        if trigStatus == 'STOP':
+            edev.set_server('Stop')
+            edev.printw('Scope was stopped externally. Server stopped.')
+            return False
     except visa.errors.VisaIOError as e:
         edev.printe(f'VisaIOError in query for trigger: {e}')
         for exc in C_.exceptionCount:
@@ -482,6 +738,59 @@ def trigger_is_detected():
     return False
 
 #``````````````````Acquisition-related functions``````````````````````````````
+def publish_waveform(ch, samples, vdiv, offset, t):
+    """Convert raw samples of a channel to volts and publish them"""
+    # Convert to voltage (simplified)
+    # TODO: For production use, parse VERTICAL_GAIN and VERTICAL_OFFSET from
+    # WAVEDESC structure for accurate voltage conversion
+    v = samples * vdiv / LECROY_VERTICAL_RESOLUTION  # Approximate scaling
+    edev.publish(f'c{ch:02}Waveform', v+offset, t=t)
+    edev.publish(f'c{ch:02}Peak2Peak', np.ptp(v), t=t)
+    edev.publish(f'c{ch:02}Mean', v.mean(), t=t)
+    if C_.compression != 'None':
+        publish_compressed(ch, samples, vdiv, offset, t)
+
+def publish_compressed(ch, samples, vdiv, offset, t):
+    """Compress the raw samples of a channel in the compression thread"""
+    if not C_.compressSlots.acquire(blocking=False):
+        edev.printv(f'Compression is late, waveform of channel {ch} skipped')
+        return
+    C_.compressExecutor.submit(compress_waveform, ch, samples, C_.compression,
+        [vdiv/LECROY_VERTICAL_RESOLUTION, offset, C_.xincrement], t)
+
+def compress_waveform(ch, samples, codec, scaling, t):
+    """Delta-encode and compress raw samples, publish them with descriptor"""
+    try:
+        ts = time.thread_time()
+        delta = np.empty(len(samples), dtype='<i2')
+        delta[:1] = samples[:1]
+        np.subtract(samples[1:], samples[:-1], out=delta[1:])# wraps around
+        level = min(edev.pvv('compressLevel'),
+            COMPRESSION_MAXLEVEL[COMPRESSION_CODECS.index(codec)])
+        if codec == 'zlib':
+            z = zlib.compress(delta.tobytes(), level)
+        else:
+            z = lz4.frame.compress(delta.tobytes(), compression_level=level)
+        C_.compressStats[0] += 1
+        C_.compressStats[1] += delta.nbytes
+        C_.compressStats[2] += len(z)
+        C_.compressStats[3] += time.thread_time() - ts
+        edev.publish(f'c{ch:02}WaveformZDesc',
+            [COMPRESSION_CODECS.index(codec), len(samples)] + scaling, t=t)
+        edev.publish(f'c{ch:02}WaveformZ', np.frombuffer(z, dtype=np.uint8), t=t)
+    except Exception as e:
+        edev.printe(f'Exception in compression of channel {ch}: {e}')
+    finally:
+        C_.compressSlots.release()
+
+def update_compressStats():
+    """Publish compression ratio and CPU time"""
+    waveforms, rawBytes, compressedBytes, cpuTime = C_.compressStats
+    if waveforms > 0:
+        edev.publish('compressRatio', round(rawBytes/compressedBytes, 3))
+        edev.publish('compressTime', round(cpuTime/waveforms, 6))
+    C_.compressStats = [0, 0, 0, 0.]
+
 def acquire_waveforms():
     """Acquire waveforms from the device and publish them."""
     edev.printv(f'>acquire_waveform for channels {C_.channelsTriggered}')
@@ -496,11 +805,8 @@ def acquire_waveforms():
             ts = timer()
             operation = 'getting waveform'
             
-            with Threadlock:
-                # Request waveform data from LeCroy
-                C_.scope.write(f'C{ch}:WF? DAT1')
-                # Read binary data
-                raw_data = C_.scope.read_raw()
+            # Request waveform data from LeCroy and read binary data
+            raw_data = scope_io(PRIO_ACQ, write_read_raw, f'C{ch}:WF? DAT1')
             
             ElapsedTime['query_wf'] += timer() - ts
             
@@ -518,21 +824,16 @@ def acquire_waveforms():
                         waveform = np.frombuffer(raw_data[LECROY_DESCRIPTOR_SIZE:], dtype=np.int16)
                         
                         # Get vertical scaling
-                        with Threadlock:
-                            vdiv = float(C_.scope.query(f'C{ch}:VOLT_DIV?'))
-                            offset = float(C_.scope.query(f'C{ch}:OFFSET?'))
-                        
-                        # Convert to voltage (simplified)
-                        # TODO: For production use, parse VERTICAL_GAIN and VERTICAL_OFFSET from
-                        # WAVEDESC structure for accurate voltage conversion
-                        v = waveform * vdiv / LECROY_VERTICAL_RESOLUTION  # Approximate scaling
+                        vdiv = float(scope_io(PRIO_ACQ, C_.scope.query, f'C{ch}:VOLT_DIV?'))
+                        offset = float(scope_io(PRIO_ACQ, C_.scope.query, f'C{ch}:OFFSET?'))
                         
+                        if pargs.record:
+                            record_waveform(ch, waveform, vdiv, offset)
+
                         # publish
                         ts = timer()
                         operation = 'publishing'
-                        edev.publish(f'c{ch:02}Waveform', v+offset, t=C_.trigTime)
-                        edev.publish(f'c{ch:02}Peak2Peak', np.ptp(v), t = C_.trigTime)
-                        edev.publish(f'c{ch:02}Mean', v.mean(), t = C_.trigTime)
+                        publish_waveform(ch, waveform, vdiv, offset, C_.trigTime)
                         ElapsedTime['publish_wf'] += timer() - ts
             except Exception as e:
                 edev.printe(f'Error parsing waveform data for channel {ch}: {e}')
@@ -546,6 +847,182 @@ def acquire_waveforms():
     ElapsedTime['acquire_wf'] = timer() - ElapsedTime['acquire_wf']
     edev.printvv(f'elapsedTime: {ElapsedTime}')
 
+#``````````````````Scope-side statistics`````````````````````````````````````````
+def stats_channels():
+    """Channels, which have measurement slots for scope-side statistics"""
+    return range(1, min(pargs.channels, MEASURE_SLOTS//len(STATS_PARAMS))+1)
+
+def measure_slot(ch, param):
+    """VBS path of the measurement slot, used for param of channel ch"""
+    return f'app.Measure.P{(ch-1)*len(STATS_PARAMS)+STATS_PARAMS.index(param)+1}'
+
+def configure_scopeStats(on:bool):
+    """Configure scope-side averaging and measurement statistics.
+    Measurements are done on raw channels, so that the statistics cover
+    every trigger. The averaging is done on math traces F<n>."""
+    if not on:
+        cmds = ['app.Measure.StatsOn = False', 'app.Measure.ClearSweeps']
+        cmds += [f'app.Math.F{ch}.View = False' for ch in stats_channels()]
+        for cmd in cmds:
+            scope_io(PRIO_SETTING, C_.scope.write, 'VBS '+cmd)
+        return
+    if pargs.channels > MEASURE_SLOTS//len(STATS_PARAMS):
+        edev.printw(f'Scope-side statistics are limited to {len(stats_channels())} channels')
+    cmds = []
+    items = ['app.Acquisition.TriggerMode']
+    for ch in stats_channels():
+        cmds += [f'app.Math.F{ch}.MathMode = "OneOperator"',
+            f'app.Math.F{ch}.Operator1 = "Average"', f'app.Math.F{ch}.Source1 = "C{ch}"',
+            f'app.Math.F{ch}.Operator1Setup.Sweeps = {edev.pvv("avgSweeps")}',
+            f'app.Math.F{ch}.View = True']
+        for param in STATS_PARAMS:
+            slot = measure_slot(ch, param)
+            cmds += [f'{slot}.ParamEngine = "{param}"', f'{slot}.Source1 = "C{ch}"']
+            items.append(f'{slot}.mean.Result.Value')
+        items.append(f'{measure_slot(ch, STATS_PARAMS[0])}.num.Result.Value')
+    cmds += ['app.Measure.ShowMeasure = True', 'app.Measure.StatsOn = True',
+        'app.Measure.ClearSweeps']
+    for cmd in cmds:
+        scope_io(PRIO_SETTING, C_.scope.write, 'VBS '+cmd)
+    # trigger mode and all results are read in one query, separated by commas
+    C_.statsQuery = 'VBS? return=' + ' & "," & '.join(items)
+    C_.statsSweeps = (None, 0, timer())
+
+def read_scopeStats():
+    """Read accumulated scope-side statistics and publish them"""
+    reply = scope_io(PRIO_ACQ, C_.scope.query, C_.statsQuery)
+    trigMode, *values = reply.strip().replace('VBS ','',1).split(',')
+    trigStatus = VBS_TRIGGER_MODES.get(trigMode, trigMode)
+    edev.publish('trigState', trigStatus, IF_CHANGED)
+    if trigStatus == 'STOP':
+        edev.set_server('Stop')
+        edev.printw('Scope was stopped externally. Server stopped.')
+        return
+    t = time.time()
+    nvalues = len(STATS_PARAMS) + 1
+    rateChannel = None# the rate is derived from the first channel with valid results
+    for idx,ch in enumerate(stats_channels()):
+        try:
+            meanAvg, p2pAvg, sweeps = [float(v) for v in values[idx*nvalues:(idx+1)*nvalues]]
+        except ValueError:# no data yet or unexpected reply
+            edev.printv(f'No scope-side statistics for channel {ch}: {values}')
+            continue
+        sweeps = int(sweeps)
+        edev.publish(f'c{ch:02}MeanAvg', meanAvg, t=t)
+        edev.publish(f'c{ch:02}Peak2PeakAvg', p2pAvg, t=t)
+        edev.publish(f'c{ch:02}Sweeps', sweeps, t=t)
+        if rateChannel is None:
+            rateChannel = ch
+            prevChannel, prevSweeps, prevTime = C_.statsSweeps
+            tnow = timer()
+            if ch == prevChannel and sweeps >= prevSweeps and tnow > prevTime:
+                edev.publish('sweepRate', round((sweeps - prevSweeps)/(tnow - prevTime), 3))
+                edev.publish('acqCount', edev.pvv('acqCount') + sweeps - prevSweeps, t=t)
+            C_.statsSweeps = (ch, sweeps, tnow)
+
+#``````````````````Recording and replay`````````````````````````````````````````
+def record_waveform(ch, samples, vdiv, offset):
+    """Append raw samples of a channel and their descriptor to the recording"""
+    if ch not in C_.recordFiles:
+        os.makedirs(pargs.record, exist_ok=True)
+        fn = os.path.join(pargs.record, f'c{ch:02}')
+        C_.recordFiles[ch] = (open(fn+'.dat','ab'), open(fn+'.desc','ab'))
+    samplesFile, descFile = C_.recordFiles[ch]
+    samplesFile.write(samples.astype('<i2').tobytes())
+    desc = np.array([C_.trigTime, vdiv, offset, C_.xincrement, len(samples)], dtype='<f8')
+    descFile.write(desc.tobytes())
+
+def flush_recording(close=False):
+    """Flush recorded data to disk, so that the recording can be replayed while it grows"""
+    for files in C_.recordFiles.values():
+        for f in files:
+            f.flush()
+            if close:
+                f.close()
+    if close:
+        C_.recordFiles = {}
+
+def init_replay():
+    """Memory-map recorded acquisitions for replay"""
+    for ch in range(1, pargs.channels+1):
+        fn = os.path.join(pargs.replay, f'c{ch:02}')
+        try:
+            # map only complete descriptors, the last one could be truncated
+            ndesc = os.path.getsize(fn+'.desc') // (8*len(RECORD_DESC))
+            if ndesc == 0:
+                continue
+            desc = np.memmap(fn+'.desc', dtype='<f8', mode='r', shape=(ndesc, len(RECORD_DESC)))
+            samples = np.memmap(fn+'.dat', dtype='<i2', mode='r')
+        except (OSError, ValueError) as e:
+            edev.printv(f'No recording for channel {ch}: {e}')
+            continue
+        starts = np.concatenate(([0], np.cumsum(desc[:,RECORD_DESC.index('npoints')].astype(int))))
+        # the last acquisition could be truncated if recording was interrupted
+        count = np.searchsorted(starts, len(samples), side='right') - 1
+        C_.replay[ch] = (samples, desc[:count], starts)
+        edev.printi(f'Replaying {count} acquisitions of channel {ch} from {fn}.dat')
+    if not C_.replay:
+        edev.printe(f'No recorded acquisitions found in {pargs.replay}')
+        sys.exit(1)
+    C_.replayCount = min(len(desc) for _,desc,_ in C_.replay.values())
+    C_.channelsTriggered = sorted(C_.replay)
+    C_.replayStats[2] = timer()
+    # Pacing is done by replay_poll(), the main loop should not throttle it
+    edev.publish('sleep', 0.001)
+
+def replay_acquisition(idx):
+    """Publish the recorded acquisition idx of all channels"""
+    t = time.time()
+    edev.publish('acqCount', edev.pvv('acqCount') + 1, t=t)
+    for ch, (samples, desc, starts) in C_.replay.items():
+        trigTime, vdiv, offset, xincrement, npoints = desc[idx]
+        if xincrement != C_.xincrement or npoints != C_.npoints:
+            C_.xincrement, C_.npoints = xincrement, int(npoints)
+            edev.publish('tAxis', np.arange(0, C_.npoints) * C_.xincrement)
+            edev.publish('recLengthR', C_.npoints, IF_CHANGED)
+            if C_.xincrement > 0:
+                edev.publish('samplingRate', 1./C_.xincrement, IF_CHANGED)
+        publish_waveform(ch, samples[starts[idx]:starts[idx+1]], vdiv, offset, t)
+
+def replay_poll():
+    """Publish recorded acquisitions, paced by the replayRate PV"""
+    rate = edev.pvv('replayRate')
+    if rate != C_.replayRate:# rate changed, restart the schedule
+        C_.replayRate = rate
+        C_.replayNext = timer()
+    tstart = timer()
+    while timer() - tstart < REPLAY_SLICE:
+        if C_.replayIndex >= C_.replayCount:
+            if str(edev.pvv('replayLoop')) != 'Loop':
+                edev.printi('Replay finished')
+                edev.set_server('Stop')
+                return
+            C_.replayIndex = 0
+        if rate > 0.:
+            wait = C_.replayNext - timer()
+            if wait > 0.:
+                if timer() + wait - tstart > REPLAY_SLICE:
+                    return
+                time.sleep(wait)
+            C_.replayNext += 1./rate
+        ts = timer()
+        replay_acquisition(C_.replayIndex)
+        C_.replayStats[0] += 1
+        C_.replayStats[1] += timer() - ts
+        C_.replayIndex += 1
+
+def update_replayStats():
+    """Publish achieved replay rate and backpressure"""
+    published, publishTime, startTime = C_.replayStats
+    tnow = timer()
+    if published > 0:
+        edev.publish('replayRateR', round(published/(tnow - startTime), 3))
+        edev.publish('replayPublishTime', round(publishTime/published, 6))
+    lag = tnow - C_.replayNext if C_.replayRate > 0. else 0.
+    edev.publish('replayLag', round(max(lag, 0.), 6))
+    edev.publish('replayIndex', C_.replayIndex)
+    C_.replayStats = [0, 0., tnow]
+
 def make_readSettingQuery():
     """Create SCPI map for reading settings"""
     for pvdef in C_.PvDefs:
@@ -569,30 +1046,104 @@ def make_readSettingQuery():
     edev.printv(f'SCPI map created with {len(C_.scpi)} entries')
     edev.printv(f'setterMap: {C_.setterMap}')
 
+def profiled(func):
+    """Call func, profile it if profiling is running"""
+    profiler = C_.profiler
+    if profiler is None:
+        return func()
+    profiler.enable()
+    try:
+        return func()
+    finally:
+        profiler.disable()
+
+def finish_profile(profiler):
+    """Publish top functions of the profiler and save full statistics to file"""
+    C_.profiler = None
+    ioProfiler, C_.ioProfiler = C_.ioProfiler, None
+    stream = io.StringIO()
+    stats = None
+    for prof in (profiler, ioProfiler):
+        if prof is None:
+            continue
+        try:
+            if stats is None:
+                stats = pstats.Stats(prof, stream=stream)
+            else:
+                stats.add(prof)
+        except TypeError:# nothing was profiled
+            pass
+    edev.publish('profile', 'Profile')
+    if stats is None:
+        edev.publish('profileStats', 'No calls were profiled')
+        return
+    fn = os.path.join(pargs.profileDir, f'{pargs.prefix.rstrip(":")}_{time.strftime("%y%m%d_%H%M%S")}.prof')
+    try:
+        stats.dump_stats(fn)
+    except OSError as e:
+        edev.printe(f'Could not save profile statistics to {fn}: {e}')
+        fn = None
+    stats.strip_dirs().sort_stats('tottime').print_stats(PROFILE_TOPN)
+    edev.publish('profileStats', stream.getvalue())
+    if fn is not None:
+        edev.printi(f'Profile statistics saved to {fn}')
+
+def update_profilePV():
+    """Make the profile PV consistent with the profiling state, regardless
+    of the value posted by a put"""
+    shown = str(edev.pvv('profile'))
+    if C_.profiler is None and shown != 'Profile':
+        edev.publish('profile', 'Profile')
+    elif C_.profiler is not None and shown == 'Profile':
+        edev.publish('profile', 'Start')
+
+def update_modePVs():
+    """Make the mode PVs consistent with the modes in use, the value posted
+    by a put could differ if the setter rejected it"""
+    for pvName, mode in (('statsMode', C_.statsMode), ('compression', C_.compression)):
+        if str(edev.pvv(pvName)) != mode:
+            edev.publish(pvName, mode)
+
 def init():
     """Module initialization"""
+    if pargs.replay:
+        make_readSettingQuery()
+        init_replay()
+        return
     init_visa()
+    init_io()
     make_readSettingQuery()
     adopt_local_setting()
 
 def periodicUpdate():
     """Called for infrequent updates"""
-    while Threadlock.locked():
-        edev.printi('periodicUpdate waiting for lock to be released')
-        time.sleep(0.1)
+    update_compressStats()
+    if pargs.replay:
+        update_replayStats()
+        return
     try:
         update_scopeParameters()
     except Exception:
         handle_exception('in update_scopeParameters')
+    update_ioStats()
+    flush_recording()
     edev.publish('lostTrigs', C_.triggersLost, IF_CHANGED)
     edev.publish('timing', [(round(i,6)) for i in ElapsedTime.values()])
 
 def poll():
     """Instrument polling function"""
+    if pargs.replay:
+        replay_poll()
+        return
+    if C_.statsMode == 'Scope':
+        try:
+            read_scopeStats()
+        except Exception:
+            handle_exception('in read_scopeStats')
+        return
     if trigger_is_detected():
         time.sleep(0.1)  # Small delay for LeCroy to complete acquisition
-        with Threadlock:
-            acquire_waveforms()
+        acquire_waveforms()
 
 #``````````````````Main```````````````````````````````````````````````````````
 if __name__ == "__main__":
@@ -610,6 +1161,14 @@ if __name__ == "__main__":
     'Resource string to access the device, e.g. TCPIP::192.168.1.100::1861::SOCKET')
     parser.add_argument('-v', '--verbose', action='count', default=0, help=
     'Show more log messages (-vv: show even more)') 
+    parser.add_argument('--profileDir', default='/tmp', help=
+    'Directory for profile statistics files, produced by the profile PV')
+    parser.add_argument('--record', help=
+    'Directory to record acquired waveforms for later replay')
+    parser.add_argument('--replay', help=
+    'Directory of recorded waveforms, publish them instead of acquiring from the device')
+    parser.add_argument('--replayRate', type=float, default=0., help=
+    'Initial rate of replayed acquisitions [Hz], 0: as fast as possible')
     pargs = parser.parse_args()
     print(f'pargs: {pargs}')
 
@@ -632,7 +1191,13 @@ if __name__ == "__main__":
         if state.startswith('Exit'):
             break
         if not state.startswith('Stop'):
-            poll()
+            profiled(poll)
         if not edev.sleep():
-            periodicUpdate()
+            profiled(periodicUpdate)
+        if C_.profiler is not None and time.time() > C_.profileEnd:
+            finish_profile(C_.profiler)
+        update_profilePV()
+        update_modePVs()
+    flush_recording(close=True)
+    stop_io()
     edev.printi('Server is exited')